@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-DiscoverCars: многопоточный BFS-краулер с отдельным прокси на поток.
+DiscoverCars: многопоточный BFS-краулер, несколько потоков на каждый прокси.
 """
 
 
 from __future__ import annotations
-import requests, csv, json, html, re, string, time, pathlib, pickle, sys, queue, threading
-from collections import Counter
-from datetime import datetime, timedelta
-from typing import Dict, Any, Iterable, List
+import numpy as np, requests, orjson, csv, html, os, random, re, string, time, pathlib, pickle, sqlite3, sys, queue, threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import IO, Dict, Any, Iterable, List, TextIO
 from requests.adapters import HTTPAdapter, Retry
 from rich.console import Console
 from rich.table import Table
@@ -25,220 +26,643 @@ OUT        = pathlib.Path("out");   OUT.mkdir(exist_ok=True)
 CACHE_DIR  = pathlib.Path("cache"); CACHE_DIR.mkdir(exist_ok=True)
 CSV_PATH   = OUT / "discovercars_live.csv"
 JSON_PATH  = OUT / "discovercars_live.jsonl"
-STATE_PATH = CACHE_DIR / "queue_state.pkl"
+STATE_PATH = CACHE_DIR / "queue_state.pkl"   # счётчик префиксов
+DB_PATH    = CACHE_DIR / "state.db"          # seen + очередь, инкрементально
 
 
 DELAY        = 0.12
 MAX_DEPTH    = 4
-BACKUP_EVERY = timedelta(minutes=2)
-N_THREADS    = 8                      # потоков ≈ числу прокси
+BACKUP_EVERY_S = 120.0                # сек. между backup'ами и fsync файлов
 PROXY_LIST   = [l.strip() for l in open("proxies.txt") if l.strip()]
+WORKERS_PER_PROXY = 4                 # одновременных запросов через один прокси
+N_THREADS    = len(PROXY_LIST) * WORKERS_PER_PROXY
+PROXY_FAILS  = 3                      # неудач подряд (у всех его потоков) → карантин…
+PROXY_QUARANTINE = 60.0               # …на столько секунд
+PREFIX_TRIES = 5                      # неудачных попыток на префикс, потом пропуск
+IDLE_EXIT    = 3.0                    # сек. без работы во всех деках → поток выходит
+SEEN_SHARDS  = 32                     # степень двойки: шард = hash(uid) & (N-1)
+# в памяти держим не ключи, а их 64-битные hash() — отсортированным массивом
+# uint64 на шард, 8 байт на точку; точный список ID — в SQLite (PRIMARY KEY)
+STATE_BATCH  = 1000                   # операций с базой на транзакцию
 
 
 console = Console()
-stats    = Counter()
+# счётчики потока (processed, stats по кодам HTTP): пишет только сам поток,
+# монитор раз в секунду суммирует — без общих, «скачущих» между ядрами объектов
+worker_local = threading.local()
 
 
 # ───── Session factory ────────────────────────────────────────────────────
 def make_session(proxy: str | None) -> requests.Session:
     s = requests.Session()
-    s.headers.update({"User-Agent": UA})
+    s.headers.update({"User-Agent": UA, "Connection": "keep-alive",
+                      "Accept-Encoding": "gzip, deflate"})
     retry = Retry(total=5, backoff_factor=0.5,
                   status_forcelist=[429,500,502,503,504],
                   allowed_methods=["GET"], raise_on_status=False)
-    s.mount("https://", HTTPAdapter(max_retries=retry))
+    # сессию делят потоки прокси: пул не меньше их числа, иначе лишние
+    # соединения закрываются после запроса и TLS поднимается заново
+    s.mount("https://", HTTPAdapter(max_retries=retry,
+                                    pool_connections=N_THREADS,
+                                    pool_maxsize=N_THREADS,
+                                    pool_block=False))
     if proxy:
         s.proxies.update({"http": proxy, "https": proxy})
     return s
 
 
 # ───── CSV helpers (writer-поток) ─────────────────────────────────────────
-csv_lock = threading.Lock()          # гарантируем атомарность записи
+# файлы трогает только writer-поток, поэтому lock не нужен
+WRITE_BUFFER = 1 << 20               # 1 MiB буфер ⇒ ~1 write() на мегабайт
+WRITE_BATCH  = 256                   # строк в пачке…
+WRITE_EVERY  = 1.0                   # …или секунд с прошлой записи
+WRITE_POLL   = 0.05                  # пауза writer-потока, когда ящики пусты
 
 
-def ensure_csv_header(fieldnames: List[str]):
-    with csv_lock:
-        if CSV_PATH.exists():
-            return
-        with CSV_PATH.open("w", newline="", encoding="utf-8") as f:
-            csv.DictWriter(f, fieldnames=fieldnames,
-                           extrasaction="ignore").writeheader()
+FIRST_FIELDS = ["country","countryID","city","cityID","location",
+                "place","placeID","lat","lng"]
+
+
+def open_csv(rows: List[Dict[str, Any]]) -> tuple[TextIO, Any, List[str]]:
+    """Обычный csv.writer: строки-словари раскладываем по схеме сами
+    (csv_rows), без построчного Python-кода DictWriter.
+
+    Схема — заголовок уже существующего файла (после resume колонки не
+    съедут); для нового файла — FIRST_FIELDS, затем прочие ключи первой
+    пачки по алфавиту.
+    """
+    fieldnames = None
+    if CSV_PATH.exists():
+        with CSV_PATH.open(newline="", encoding="utf-8") as fh:
+            fieldnames = next(csv.reader(fh), None)
+    fp = CSV_PATH.open("a", buffering=WRITE_BUFFER, newline="",
+                       encoding="utf-8")
+    writer = csv.writer(fp)
+    if not fieldnames:
+        keys = {k for r in rows for k in r}
+        fieldnames = FIRST_FIELDS + sorted(keys - set(FIRST_FIELDS))
+        writer.writerow(fieldnames)
+    return fp, writer, fieldnames
 
 
-def append_rows(rows: List[Dict[str,Any]], fieldnames: List[str]):
-    with csv_lock:
-        with CSV_PATH.open("a", newline="", encoding="utf-8") as f:
-            csv.DictWriter(f, fieldnames=fieldnames,
-                           extrasaction="ignore").writerows(rows)
-        with JSON_PATH.open("a", encoding="utf-8") as jf:
-            for r in rows:
-                jf.write(json.dumps(r, ensure_ascii=False) + "\n")
+def csv_rows(rows: List[Dict[str, Any]], fieldnames: List[str]) -> Iterable:
+    # map(row.get, …) целиком в C; нет ключа → None → пустая ячейка, как
+    # restval="" у DictWriter; лишние ключи отбрасываются (extrasaction="ignore")
+    return (map(row.get, fieldnames) for row in rows)
+
+
+def sync_file(fp: IO):
+    fp.flush()
+    os.fsync(fp.fileno())
 
 
 # ───── API helpers (как в соло-версии) ────────────────────────────────────
-def get_csrf(sess: requests.Session) -> str:
-    html_text = sess.get(ROOT, timeout=30).text
-    return html.unescape(re.search(
-        r'<meta name="csrf-token"\s+content="([^"]+)"',
-        html_text)[1])
-
-
-def api_call(sess: requests.Session, prefix: str, token: str,
-             retries: int = 3) -> list[Dict[str, Any]]:
-    url = f"{ROOT}/en/search/autocomplete/{prefix}"
-    hdr = {
-        "x-csrf-token": token,
-        "x-kl-ajax-request": "Ajax_Request",
-        "x-requested-with": "XMLHttpRequest",
-        "referer": ROOT + "/",
-        "accept": "application/json, text/plain, */*",
-    }
+CSRF_TAG = b'<meta name="csrf-token" content="'
+CSRF_RE  = re.compile(rb'<meta name="csrf-token"\s+content="([^"]+)"')
+
+
+def get_csrf(sess: requests.Session) -> str | None:
+    """CSRF-токен с главной; None — токена на странице нет (блок, капча)."""
+    r = sess.get(ROOT, timeout=30)
+    r.raise_for_status()
+    body = r.content                            # bytes: без декода всей страницы
+    i = body.find(CSRF_TAG)                     # литерал ищется быстрее regex
+    j = body.find(b'"', i + len(CSRF_TAG)) if i >= 0 else -1
+    if j >= 0:
+        token = body[i + len(CSRF_TAG):j]
+    else:                                       # другие пробелы в теге
+        m = CSRF_RE.search(body)                # или тег без закрывающей "
+        if m is None:
+            return None
+        token = m[1]
+    return html.unescape(token.decode())
+
+
+PREFIX_URL = f"{ROOT}/en/search/autocomplete/"
+UID_FIELDS = {"location", "placeID"}         # без них точку не опознать
+API_HDR = {
+    "x-kl-ajax-request": "Ajax_Request",
+    "x-requested-with": "XMLHttpRequest",
+    "referer": ROOT + "/",
+    "accept": "application/json, text/plain, */*",
+}
+
+
+def api_headers(token: str) -> Dict[str, str]:
+    """Заголовки API с токеном — собираются один раз на поток."""
+    return {**API_HDR, "x-csrf-token": token}
+
+
+class TokenExpired(Exception):
+    """403/419 от API: CSRF-токен прокси протух, нужен новый."""
+
+
+def api_call(sess: requests.Session, prefix: str, hdr: Dict[str, str],
+             retries: int = 3) -> list[Dict[str, Any]] | None:
+    """Точки по префиксу; None — запрос не удался или ответ не список точек
+    (страница блокировки с кодом 200), префикс надо повторить;
+    TokenExpired — API отверг токен."""
+    url = PREFIX_URL + prefix
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(0.5 * (1 << attempt))      # 1, 2, 4 с
+        try:
+            r = sess.get(url, headers=hdr, timeout=60)
+            worker_local.counters.stats[r.status_code] += 1
+            if r.status_code == 404:
+                return []
+            if r.status_code in (403, 419):
+                raise TokenExpired(prefix)
+            r.raise_for_status()
+            data = orjson.loads(r.content)   # UTF-8 JSON: без угадывания кодировки
+        except requests.exceptions.HTTPError as e:
+            tqdm.write(f"[HTTP] {prefix}: {e}")
+            return None
+        except orjson.JSONDecodeError as e:
+            tqdm.write(f"[JSON] {prefix}: {e}")
+            return None
+        except (requests.exceptions.ReadTimeout,
+                requests.exceptions.ConnectionError) as e:
+            err = e
+            continue
+        if not (isinstance(data, list) and all(
+                isinstance(obj, dict) and UID_FIELDS <= obj.keys()
+                for obj in data)):
+            tqdm.write(f"[JSON] {prefix}: не список точек")
+            return None
+        return data
+    tqdm.write(f"[TIMEOUT] {prefix}: {err}")
+    return None
+
+
+# ───── прокси: пул живых + карантин ───────────────────────────────────────
+def probe_proxy(sess: requests.Session) -> str | None:
+    """Стартовая проверка прокси: CSRF-токен или None, если прокси не отвечает
+    или вместо сайта отдаёт страницу без токена."""
     try:
-        r = sess.get(url, headers=hdr, timeout=60)
-        stats[str(r.status_code)] += 1
-        if r.status_code == 404:
-            return []
-        r.raise_for_status()
-        return r.json()
-    except (requests.exceptions.ReadTimeout,
-            requests.exceptions.ConnectionError) as e:
-        if retries:
-            time.sleep(2)
-            return api_call(sess, prefix, token, retries-1)
-        tqdm.write(f"[TIMEOUT] {prefix}: {e}")
-        return []
+        token = get_csrf(sess)
+    except requests.exceptions.RequestException as e:
+        tqdm.write(f"[PROXY] пропускаю: {e}")
+        return None
+    if token is None:
+        tqdm.write("[PROXY] пропускаю: на главной нет CSRF-токена")
+    return token
+
+
+def pick_proxy(proxy_until: List[float],
+               stop_evt: threading.Event) -> int | None:
+    """Случайный прокси не в карантине (proxy_until[k] — до какого
+    time.monotonic() прокси k отдыхает); если в карантине все — ждём.
+    None — пока ждали, crawl остановили."""
+    while True:
+        now = time.monotonic()
+        healthy = [k for k, until in enumerate(proxy_until) if until <= now]
+        if healthy:
+            return random.choice(healthy)
+        if stop_evt.wait(min(proxy_until) - now):
+            return None
+
+
+def refresh_token(sessions: List[requests.Session],
+                  headers: List[Dict[str, str]],
+                  token_locks: List[threading.Lock],
+                  proxy_until: List[float], k: int, stale: Dict[str, str]):
+    """Новый CSRF-токен для прокси k. Обновляет один поток, соседи с тем же
+    протухшим токеном (stale) ждут на lock'е и берут готовый. Не вышло —
+    прокси в карантин."""
+    with token_locks[k]:
+        if headers[k] is not stale:             # сосед уже обновил
+            return
+        try:
+            token = get_csrf(sessions[k])
+        except requests.exceptions.RequestException as e:
+            tqdm.write(f"[TOKEN] #{k}: {e}")
+            token = None
+        if token:
+            headers[k] = api_headers(token)
+            tqdm.write(f"[TOKEN] #{k} обновлён")
+        else:
+            tqdm.write(f"[PROXY] #{k} без токена → в карантин на {PROXY_QUARANTINE:.0f} с")
+            proxy_until[k] = time.monotonic() + PROXY_QUARANTINE
 
 
 # ───── сохранение / загрузка состояния ───────────────────────────────────
-def load_previous():
-    if not STATE_PATH.exists():
-        return set(), list(string.ascii_lowercase), 0
-    with STATE_PATH.open("rb") as fh:
-        state = pickle.load(fh)
-    console.print("[yellow]⏪  Продолжаю прошлый запуск…[/]")
-    return state["seen_ids"], state["queue"], state["processed"]
+def open_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")     # чтение не ждёт запись
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # place_id — всегда строкой (см. point_uid), как и в старом pickle
+    conn.execute("CREATE TABLE IF NOT EXISTS seen "
+                 "(location TEXT, place_id TEXT, "
+                 "PRIMARY KEY (location, place_id))")
+    conn.execute("CREATE TABLE IF NOT EXISTS queue (prefix TEXT PRIMARY KEY)")
+    return conn
 
 
-def save_state(seen, queue, processed):
-    pickle.dump({"seen_ids": seen, "queue": queue,
-                 "processed": processed}, STATE_PATH.open("wb"))
+def point_uid(obj: Dict[str, Any]) -> tuple:
+    """Ключ точки из ответа API. placeID приводим к строке: тип в JSON нам
+    не гарантирован, а ключи из старого pickle — строки."""
+    return obj['location'], str(obj['placeID'])
 
 
-# ───── worker + writer поток ─────────────────────────────────────────────
-def writer_thread(rows_q: "queue.Queue[list[Dict]]", fieldnames_ref):
-    """Забирает списки строк из очереди и пишет в файлы."""
-    while True:
-        rows = rows_q.get()
-        if rows is None:          # сигнал остановки
-            break
-        if rows and fieldnames_ref[0] is None:
-            fieldnames = list({k for r in rows for k in r})
-            first = ["country","countryID","city","cityID","location","place",
-                     "placeID","lat","lng"]
-            fieldnames = first + [k for k in fieldnames if k not in first]
-            fieldnames_ref[0] = fieldnames
-            ensure_csv_header(fieldnames)
-        append_rows(rows, fieldnames_ref[0])
-        rows_q.task_done()
-
-
-def worker(thread_id: int, prefix_q: "queue.Queue[str]",
-           rows_q: "queue.Queue[list[Dict]]",
-           seen_ids: set[str], seen_lock: threading.Lock,
-           processed_counter, processed_lock: threading.Lock):
-    sess = make_session(PROXY_LIST[thread_id % len(PROXY_LIST)])
-    token = get_csrf(sess)
-    while True:
+def legacy_uid(uid: str) -> tuple:
+    """«location:placeID» из старого pickle → ключ-кортеж."""
+    location, _, place_id = uid.rpartition(":")
+    return location, place_id
+
+
+def uid_keys(uids: Iterable[tuple]) -> np.ndarray:
+    return np.fromiter(map(hash, uids), np.int64).view(np.uint64)
+
+
+def load_previous():
+    """seen и очередь — из SQLite, счётчик — из pickle."""
+    conn = open_db()
+    state = {}
+    if STATE_PATH.exists():
+        with STATE_PATH.open("rb") as fh:
+            state = pickle.load(fh)
+        console.print("[yellow]⏪  Продолжаю прошлый запуск…[/]")
+    if "seen_ids" in state:       # pickle старого формата → переносим в базу
+        conn.execute("BEGIN")
+        conn.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?)",
+                         map(legacy_uid, state.pop("seen_ids")))
+        conn.executemany("INSERT OR IGNORE INTO queue VALUES (?)",
+                         ((p,) for p in state.pop("queue")))
+        conn.execute("COMMIT")
+        # сразу переписываем pickle в новом формате: иначе до первого
+        # backup'а старый queue из него перезальётся поверх уже пройденного
+        save_state(state.get("processed", 0))
+    seen = uid_keys(conn.execute("SELECT location, place_id FROM seen"))
+    queue_list = [p for (p,) in conn.execute("SELECT prefix FROM queue")]
+    if not len(seen) and not queue_list:   # первый запуск
+        queue_list = list(string.ascii_lowercase)
+        conn.executemany("INSERT INTO queue VALUES (?)",
+                         ((p,) for p in queue_list))
+    conn.close()
+    return seen, queue_list, state.get("processed", 0)
+
+
+def save_state(processed):
+    """Пишем во временный файл и подменяем им старый: оборванная запись
+    не портит прошлое состояние."""
+    tmp = STATE_PATH.with_suffix(".tmp")
+    with tmp.open("wb") as fh:
+        pickle.dump({"processed": processed}, fh,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        sync_file(fh)
+    os.replace(tmp, STATE_PATH)
+
+
+def state_writer(state_q: "queue.Queue[tuple | None]"):
+    """Пишет изменения seen/очереди в SQLite пачками по STATE_BATCH.
+
+    Операции: ("seen", [uid…]), ("push", [prefix…]), ("done", prefix);
+    порядок сохраняется, так что дети попадают в базу раньше, чем родитель
+    из неё удаляется.
+    """
+    conn = open_db()
+    stop = False
+    while not stop:
         try:
-            prefix = prefix_q.get(timeout=3)  # timeout → выходим
+            ops = [state_q.get(timeout=1)]
         except queue.Empty:
+            continue
+        while len(ops) < STATE_BATCH:
+            try:
+                ops.append(state_q.get_nowait())
+            except queue.Empty:
+                break
+        if None in ops:           # сигнал остановки
+            stop = True
+            ops = ops[:ops.index(None)]
+        conn.execute("BEGIN")
+        for op, arg in ops:
+            if op == "seen":
+                conn.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?)",
+                                 arg)
+            elif op == "push":
+                conn.executemany("INSERT OR IGNORE INTO queue VALUES (?)",
+                                 ((p,) for p in arg))
+            else:
+                conn.execute("DELETE FROM queue WHERE prefix = ?", (arg,))
+        conn.execute("COMMIT")
+    conn.close()
+
+
+
+# ───── очередь префиксов: свои деки + work stealing ───────────────────────
+def next_prefix(slot: int, deques: List[deque],
+                locks: List[threading.Lock]) -> str | None:
+    """Берёт последний положенный префикс своей деки (LIFO), а если она
+    пуста — крадёт самый старый из чужой, начиная со случайной: он ближе
+    к корню, поддерево у него больше. None — работы нет уже IDLE_EXIT секунд."""
+    n = len(deques)
+    deadline = time.monotonic() + IDLE_EXIT
+    while True:
+        with locks[slot]:
+            if deques[slot]:
+                return deques[slot].pop()
+        start = random.randrange(n)
+        for k in range(n):
+            victim = (start + k) % n
+            if victim == slot:
+                continue
+            with locks[victim]:
+                if deques[victim]:
+                    return deques[victim].popleft()
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.05)
+
+
+# ───── seen: шарды из отсортированных uint64 ─────────────────────────────
+SHARD_MASK = np.uint64(SEEN_SHARDS - 1)
+
+
+def split_shards(keys: np.ndarray) -> List[np.ndarray]:
+    keys = np.unique(keys)                    # сортирует и убирает повторы
+    shard_ids = keys & SHARD_MASK
+    return [keys[shard_ids == h] for h in range(SEEN_SHARDS)]
+
+
+def mark_seen(keys: np.ndarray, shards: List[np.ndarray],
+              locks: List[threading.Lock]) -> np.ndarray:
+    """Маска ещё не виденных ключей ответа; новые сразу вносятся в шарды.
+
+    Все ключи ответа проверяются одним searchsorted на шард, а не по одному.
+    """
+    is_new = np.zeros(len(keys), bool)
+    uniq, first = np.unique(keys, return_index=True)   # повторы внутри ответа
+    shard_ids = uniq & SHARD_MASK
+    for h in np.unique(shard_ids):
+        in_shard = shard_ids == h
+        batch, idx = uniq[in_shard], first[in_shard]
+        with locks[h]:                # разные шарды не блокируют друг друга
+            arr = shards[h]
+            pos = np.searchsorted(arr, batch)
+            hit = arr[np.minimum(pos, len(arr) - 1)] == batch if len(arr) \
+                else np.zeros(len(batch), bool)
+            shards[h] = np.insert(arr, pos[~hit], batch[~hit])
+        is_new[idx[~hit]] = True
+    return is_new
+
+
+# ───── worker + writer поток ─────────────────────────────────────────────
+def writer_thread(outboxes: List[deque], stop_evt: threading.Event,
+                  fieldnames_ref, state_q: "queue.Queue[tuple | None]"):
+    """Обходит ящики потоков, копит пачку строк и пишет в файлы.
+
+    У каждого worker'а свой ящик (deque): append/popleft в CPython атомарны,
+    так что ни производители, ни единственный потребитель не берут lock.
+    В ящике — (строки, их uid, префикс): ("seen", …) и ("done", …) уходят
+    в базу только после того, как строки записаны, чтобы база не опережала
+    файлы. Файлы держим открытыми с большим буфером; fsync — раз
+    в BACKUP_EVERY_S и при остановке.
+    """
+    jf = JSON_PATH.open("ab", buffering=WRITE_BUFFER)   # orjson отдаёт bytes
+    csv_fp = writer = None
+    buf: List[Dict[str, Any]] = []
+    ops: List[tuple] = []                  # для базы, после записи buf
+    last_write = last_sync = time.monotonic()
+    stop = False
+    while not stop:
+        stop = stop_evt.is_set()  # флаг до выборки ⇒ после стопа ещё проход
+        taken = len(ops)
+        for box in outboxes:
+            while box:
+                rows, ids, prefix = box.popleft()
+                if rows:
+                    buf.extend(rows)
+                    ops.append(("seen", ids))
+                ops.append(("done", prefix))
+        if len(ops) == taken and not stop:
+            stop_evt.wait(WRITE_POLL)
+        now = time.monotonic()
+        if ops and (stop or len(buf) >= WRITE_BATCH
+                    or now - last_write >= WRITE_EVERY):
+            if buf and writer is None:
+                csv_fp, writer, fieldnames_ref[0] = open_csv(buf)
+            if buf:
+                writer.writerows(csv_rows(buf, fieldnames_ref[0]))
+                jf.write(b"\n".join(map(orjson.dumps, buf)) + b"\n")
+                # в ОС — сразу, до операций с базой; fsync — реже
+                csv_fp.flush()
+                jf.flush()
+                buf.clear()
+            for op in ops:
+                state_q.put(op)
+            ops.clear()
+            last_write = now
+        if stop or now - last_sync >= BACKUP_EVERY_S:
+            for fp in (csv_fp, jf):
+                if fp:
+                    sync_file(fp)
+            last_sync = now
+    if csv_fp:
+        csv_fp.close()
+    jf.close()
+
+
+def worker(slot: int, sessions: List[requests.Session],
+           headers: List[Dict[str, str]], proxy_until: List[float],
+           token_locks: List[threading.Lock],
+           proxy_fails: List[int], fails_lock: threading.Lock,
+           prefix_tries: Counter, tries_lock: threading.Lock,
+           deques: List[deque[str]], deque_locks: List[threading.Lock],
+           outbox: deque[tuple],
+           state_q: "queue.Queue[tuple | None]",
+           seen_shards: List[np.ndarray], seen_locks: List[threading.Lock],
+           counters: SimpleNamespace, stop_evt: threading.Event):
+    """Потоки одного прокси делят его сессию (пул соединений), CSRF-токен
+    и счётчик неудач. После PROXY_FAILS неудач подряд прокси уходит
+    в карантин, и все его потоки перед следующим запросом переключаются
+    на другие живые прокси. 403/419 — не вина прокси: обновляем токен.
+    Префикс, не давшийся PREFIX_TRIES раз (на любых прокси), пропускаем.
+    stop_evt — доделать текущий запрос и выйти."""
+    worker_local.counters = counters
+    alive = [k for k, until in enumerate(proxy_until) if until < float("inf")]
+    k = alive[slot % len(alive)]              # стартуем равномерно по живым
+    while not stop_evt.is_set():
+        if proxy_until[k] > time.monotonic():   # прокси в карантине
+            k = pick_proxy(proxy_until, stop_evt)
+            if k is None:
+                return
+        prefix = next_prefix(slot, deques, deque_locks)
+        if prefix is None:
             return
-        data = api_call(sess, prefix, token)
-        with processed_lock:
-            processed_counter[0] += 1
-        new_rows = []
-        with seen_lock:
-            for obj in data:
-                uid = f"{obj['location']}:{obj['placeID']}"
-                if uid not in seen_ids:
-                    seen_ids.add(uid)
-                    new_rows.append(obj)
-        if new_rows:
-            rows_q.put(new_rows)
+        hdr = headers[k]
+        try:
+            data = api_call(sessions[k], prefix, hdr)
+        except TokenExpired:          # не вина прокси: неудачей не считаем
+            data = None
+            refresh_token(sessions, headers, token_locks, proxy_until, k, hdr)
+        else:
+            if data is None:
+                with fails_lock:      # запросы, начатые до карантина, не в счёт
+                    if proxy_until[k] <= time.monotonic():
+                        proxy_fails[k] += 1
+                    bench = proxy_fails[k] >= PROXY_FAILS
+                    if bench:
+                        proxy_fails[k] = 0
+                        proxy_until[k] = time.monotonic() + PROXY_QUARANTINE
+                if bench:
+                    tqdm.write(f"[PROXY] #{k} в карантин на {PROXY_QUARANTINE:.0f} с")
+        if data is None:
+            with tries_lock:
+                prefix_tries[prefix] += 1
+                give_up = prefix_tries[prefix] >= PREFIX_TRIES
+                if give_up:
+                    del prefix_tries[prefix]
+            if give_up:
+                tqdm.write(f"[SKIP] {prefix}: {PREFIX_TRIES} неудач, пропускаю")
+                state_q.put(("done", prefix))
+            else:                     # в дальний конец деки: повторим позже
+                with deque_locks[slot]:
+                    deques[slot].appendleft(prefix)
+            continue
+        proxy_fails[k] = 0
+        if prefix_tries:              # без lock'а: пустой Counter — частый случай
+            with tries_lock:
+                prefix_tries.pop(prefix, None)
+        counters.processed += 1
+        uids = list(map(point_uid, data))
+        is_new = mark_seen(uid_keys(uids), seen_shards, seen_locks)
+        new_rows = [obj for obj, new in zip(data, is_new) if new]
+        new_ids = [uid for uid, new in zip(uids, is_new) if new]
 
 
         # углубляем префикс
         if len(data) == 10 and len(prefix) < MAX_DEPTH:
-            for ch in string.ascii_lowercase:
-                prefix_q.put(prefix + ch)
+            # в хвост своей деки, без общей блокировки: оттуда же поток
+            # и возьмёт следующий префикс (LIFO, «в глубину»)
+            kids = [prefix + ch for ch in string.ascii_lowercase]
+            state_q.put(("push", kids))       # в базу раньше, чем "done"
+            with deque_locks[slot]:
+                deques[slot].extend(kids)
 
 
-        prefix_q.task_done()
+        # строки, их "seen" и "done" префикса — через writer-поток
+        outbox.append((new_rows, new_ids, prefix))
         time.sleep(DELAY)
 
 
 # ───── многопоточный crawl ───────────────────────────────────────────────
 def crawl():
     seen_ids, queue_list, processed = load_previous()
-    prefix_q: "queue.Queue[str]" = queue.Queue()
-    for p in queue_list:
-        prefix_q.put(p)
 
 
-    seen_lock   = threading.Lock()
-    processed_lock = threading.Lock()
-    processed_counter = [processed]         # обёртка-список ⇒ byref
-    rows_q: "queue.Queue[list[Dict]]" = queue.Queue(maxsize=1000)
+    # одна сессия и один токен на прокси; заодно проверяем прокси (параллельно)
+    sessions = [make_session(p) for p in PROXY_LIST]
+    with ThreadPoolExecutor(len(sessions)) as ex:
+        tokens = list(ex.map(probe_proxy, sessions))
+    alive = [k for k, token in enumerate(tokens) if token]
+    if not alive:
+        sys.exit("Ни один прокси из proxies.txt не отвечает")
+    headers = [api_headers(token) if token else {} for token in tokens]
+    # не ответившие при старте — в «вечном» карантине
+    proxy_until = [0.0 if token else float("inf") for token in tokens]
+    token_locks = [threading.Lock() for _ in PROXY_LIST]
+    proxy_fails = [0] * len(PROXY_LIST)       # неудачи подряд, общие для потоков
+    fails_lock = threading.Lock()
+    prefix_tries: Counter = Counter()         # неудачи префиксов в этом запуске
+    tries_lock = threading.Lock()
+
+
+    n_workers = len(alive) * WORKERS_PER_PROXY
+    deques: List[deque[str]] = [deque() for _ in range(n_workers)]
+    deque_locks = [threading.Lock() for _ in range(n_workers)]
+    for i, p in enumerate(queue_list):
+        deques[i % n_workers].append(p)
+
+
+    seen_shards = split_shards(seen_ids)
+    seen_locks  = [threading.Lock() for _ in range(SEEN_SHARDS)]
+    del seen_ids
+    thread_counters = [SimpleNamespace(processed=0, stats=Counter())
+                       for _ in range(n_workers)]
+    outboxes: List[deque[tuple]] = [deque() for _ in range(n_workers)]
+    crawl_stop = threading.Event()
+    writer_stop = threading.Event()
     fieldnames_ref = [None]                 # by-reference контейнер
+    state_q: "queue.Queue[tuple | None]" = queue.Queue()
 
 
     writer = threading.Thread(target=writer_thread,
-                              args=(rows_q, fieldnames_ref), daemon=True)
+                              args=(outboxes, writer_stop, fieldnames_ref,
+                                    state_q),
+                              daemon=True)
     writer.start()
+    db_writer = threading.Thread(target=state_writer, args=(state_q,),
+                                 daemon=True)
+    db_writer.start()
 
 
     workers = [threading.Thread(
         target=worker,
-        args=(i, prefix_q, rows_q, seen_ids, seen_lock,
-              processed_counter, processed_lock),
+        args=(i, sessions, headers, proxy_until, token_locks,
+              proxy_fails, fails_lock, prefix_tries, tries_lock,
+              deques, deque_locks, outboxes[i], state_q, seen_shards, seen_locks,
+              thread_counters[i], crawl_stop),
         daemon=True)
-        for i in range(N_THREADS)]
+        for i in range(n_workers)]
     for w in workers: w.start()
 
 
-    last_backup = datetime.utcnow()
-    with Live(console=console, auto_refresh=False) as live, \
-         tqdm(total=prefix_q.qsize(),
-              bar_format="{l_bar}{bar}| {n_fmt} префиксов {elapsed}") as pbar:
-        prev_processed = processed_counter[0]
-        while any(w.is_alive() for w in workers):
-            # обновляем прогресс-бар
-            new_proc = processed_counter[0] - prev_processed
-            if new_proc:
-                pbar.update(new_proc)
-                pbar.total = prefix_q.qsize() + processed_counter[0]
-                prev_processed = processed_counter[0]
-            live.update(Table().add_row(
-                f"✓ {processed_counter[0]:,}",
-                f"★ {len(seen_ids):,}",
-                f"⏳ {prefix_q.qsize():,}"), refresh=True)
-
-
-            # периодический backup
-            if datetime.utcnow() - last_backup >= BACKUP_EVERY:
-                save_state(seen_ids, list(prefix_q.queue),
-                           processed_counter[0])
-                console.print(f"[cyan]💾 backup "
-                              f"({processed_counter[0]} префиксов)[/]")
-                last_backup = datetime.utcnow()
-            time.sleep(1)
-
-
-    # финальные штрихи
-    rows_q.put(None)       # стоп-сигнал writer-потоку
-    writer.join()
-    save_state(seen_ids, [], processed_counter[0])
-    return len(seen_ids), processed_counter[0]
+    last_backup = time.monotonic()
+    try:
+        with Live(console=console, auto_refresh=False) as live, \
+             tqdm(total=len(queue_list),
+                  bar_format="{l_bar}{bar}| {n_fmt} префиксов {elapsed}") as pbar:
+            prev_processed = processed
+            while any(w.is_alive() for w in workers):
+                # по разу за тик; деки не блокируем — для табло хватает
+                # приблизительного len(), очередь целиком не копируем
+                done = processed + sum(c.processed for c in thread_counters)
+                queued = sum(map(len, deques))
+                # Counter(c) копирует счётчик одним dict.update на C — поток
+                # не успеет добавить код посреди обхода
+                stats = sum((Counter(c.stats) for c in thread_counters),
+                            Counter())
+                # обновляем прогресс-бар
+                new_proc = done - prev_processed
+                if new_proc:
+                    pbar.update(new_proc)
+                    pbar.total = queued + done
+                    prev_processed = done
+                table = Table()          # add_row() возвращает None, не таблицу
+                table.add_row(
+                    f"✓ {done:,}",
+                    f"★ {sum(map(len, seen_shards)):,}",
+                    f"⏳ {queued:,}",
+                    " ".join(f"{code}:{n:,}" for code, n in sorted(stats.items())))
+                live.update(table, refresh=True)
+
+
+                # периодический backup
+                if time.monotonic() - last_backup >= BACKUP_EVERY_S:
+                    save_state(done)
+                    console.print(f"[cyan]💾 backup "
+                                  f"({done} префиксов)[/]")
+                    last_backup = time.monotonic()
+                time.sleep(1)
+    finally:
+        # при Ctrl+C сначала дожидаемся worker'ов с их текущими запросами,
+        # потом writer дописывает буфер и закрывает файлы, потом база
+        crawl_stop.set()
+        if any(w.is_alive() for w in workers):
+            console.print("[yellow]⏳ жду завершения текущих запросов…[/]")
+        for w in workers:
+            w.join()
+        writer_stop.set()  # стоп-сигнал writer-потоку
+        writer.join()
+        state_q.put(None)  # …и записи в базу, после строк
+        db_writer.join()
+        done = processed + sum(c.processed for c in thread_counters)
+        save_state(done)
+
+
+    return sum(map(len, seen_shards)), done
 
 
 # ───── ENTRY ──────────────────────────────────────────────────────────────